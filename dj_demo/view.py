@@ -1,24 +1,173 @@
+import datetime
 import json
-import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 
 import numpy as np
 from django.shortcuts import render
+from django.views.decorators.cache import cache_control
 import pandas as pd
 
 from pyhive import hive
+from pyhive.exc import OperationalError
 from clickhouse_driver import Client
+from clickhouse_driver.errors import ErrorCodes, ServerException
 import re
+import threading
 import time
 import platform
 from pandas.core.frame import DataFrame
+from thrift.transport.TTransport import TTransportException
+
+# clickhouse 列名中的非法字符
+NON_WORD_RE = re.compile(r'\W')
+# hive session 失效（服务端已回收）时 pyhive OperationalError 中的错误信息
+HIVE_SESSION_GONE_RE = re.compile(r'Invalid SessionHandle|session\b.*\bexpired', re.I)
+# loop_feature 按列查询 hive 的常驻线程池，查询是 IO 密集型，不需要每次请求 fork 进程
+FEATURE_POOL = ThreadPoolExecutor(max_workers=int(os.environ.get('LOOP_FEATURE_WORKERS', '42')),
+                                  thread_name_prefix='loop-feature')
+# 空闲的 hive / clickhouse 连接，按 (类型, host, port) 存放；
+# runserver 每个请求一个新线程，连接放在模块级池中才能跨请求复用
+_IDLE_CONNS = {}
+_IDLE_LOCK = threading.Lock()
+# 空闲超过该秒数的连接不再复用，避免拿到服务端已过期的 session
+_IDLE_TTL = 300
+# 每个 (类型, host, port) 最多保留的空闲连接数，多出的用完即关闭
+_IDLE_MAX = 8
+# clickhouse 表结构缓存 {(host, port, table_name): (缓存时间, 列名)}，超过 _COLUMNS_TTL 秒重新 DESCRIBE
+_COLUMNS_CACHE = {}
+_COLUMNS_TTL = 300
 
 
 def isMac():
     return platform.system() == "Darwin"
 
 
+def _close_quietly(conn, close):
+    try:
+        close(conn)
+    except Exception:
+        pass
+
+
+@contextmanager
+def _pooled_conn(key, connect, close, fresh=False):
+    # 取一个空闲连接（没有或 fresh 时新建），用完放回；出错的连接直接关闭不再复用
+    conn, expired = None, []
+    now = time.monotonic()
+    with _IDLE_LOCK:
+        idle = [] if fresh else _IDLE_CONNS.get(key, [])
+        while idle and conn is None:
+            item = idle.pop()
+            if now - item[2] < _IDLE_TTL:
+                conn = item[0]
+            else:
+                expired.append(item)
+    for item in expired:
+        _close_quietly(item[0], item[1])
+    if conn is None:
+        conn = connect()
+    try:
+        yield conn
+    except Exception:
+        _close_quietly(conn, close)
+        raise
+    _release_conn(key, conn, close)
+
+
+def _release_conn(key, conn, close):
+    # 放回空闲池，顺带关闭所有 key 下空闲超时的连接；超过 _IDLE_MAX 的直接关闭
+    now = time.monotonic()
+    discard = []
+    with _IDLE_LOCK:
+        for idle in _IDLE_CONNS.values():
+            discard.extend(item for item in idle if now - item[2] >= _IDLE_TTL)
+            idle[:] = [item for item in idle if now - item[2] < _IDLE_TTL]
+        idle = _IDLE_CONNS.setdefault(key, [])
+        if len(idle) < _IDLE_MAX:
+            idle.append((conn, close, now))
+        else:
+            discard.append((conn, close, now))
+    for item in discard:
+        _close_quietly(item[0], item[1])
+
+
+def _is_stale_hive(exc):
+    # pd.read_sql 会把 DBAPI 异常包装成 pandas 的 DatabaseError，沿异常链查找断线 / session 失效；
+    # 超时和普通 sql 错误（如表不存在）不算，不重试
+    while exc is not None:
+        if isinstance(exc, TTransportException):
+            return exc.type != TTransportException.TIMED_OUT
+        if isinstance(exc, OperationalError):
+            return bool(HIVE_SESSION_GONE_RE.search(str(exc)))
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+
+def read_hive(sql, host, port):
+    key = ('hive', host, port)
+    connect = lambda: hive.Connection(host=host, port=port)
+    close = lambda conn: conn.close()
+    try:
+        with _pooled_conn(key, connect, close) as conn:
+            return pd.read_sql(sql, conn)
+    except Exception as e:
+        if not _is_stale_hive(e):
+            raise
+        # 出错的连接已在 _pooled_conn 中关闭，其余空闲连接保留；用新建的连接重试一次
+        with _pooled_conn(key, connect, close, fresh=True) as conn:
+            return pd.read_sql(sql, conn)
+
+
+def query_clickhouse(host, port, sql, **kwargs):
+    # clickhouse_driver 的 Client 断线后会自动重连
+    key = ('clickhouse', host, port)
+    connect = lambda: Client(host=host, port=port, user='default', password='')
+    with _pooled_conn(key, connect, lambda client: client.disconnect()) as client:
+        return client.execute(sql, **kwargs)
+
+
+def clickhouse_columns(host, port, table_name, refresh=False):
+    key = (host, port, table_name)
+    cached = _COLUMNS_CACHE.get(key)
+    if not refresh and cached and time.monotonic() - cached[0] < _COLUMNS_TTL:
+        return cached[1]
+    rows = query_clickhouse(host, port, 'DESCRIBE TABLE {}'.format(table_name))
+    # 与 select * 一致，不包含 MATERIALIZED / ALIAS / EPHEMERAL 列
+    cols = tuple(row[0] for row in rows if row[2] not in ('MATERIALIZED', 'ALIAS', 'EPHEMERAL'))
+    _COLUMNS_CACHE[key] = (time.monotonic(), cols)
+    return cols
+
+
+def clickhouse_select(host, port, table_name, exclude, refresh=False):
+    # 只查询需要的列，不再 select * 后丢弃
+    cols = [col for col in clickhouse_columns(host, port, table_name, refresh) if col not in exclude]
+    return ', '.join('`{}`'.format(col) for col in cols)
+
+
+def select_clickhouse(host, port, sql, table_name, exclude, **kwargs):
+    # sql 中的两个 {} 依次为列名列表和表名；表结构变更导致列不存在时，刷新缓存后重试一次
+    try:
+        return query_clickhouse(host, port, sql.format(clickhouse_select(host, port, table_name, exclude),
+                                                       table_name), **kwargs)
+    except ServerException as e:
+        if e.code not in (ErrorCodes.UNKNOWN_IDENTIFIER, ErrorCodes.NO_SUCH_COLUMN_IN_TABLE):
+            raise
+    return query_clickhouse(host, port, sql.format(clickhouse_select(host, port, table_name, exclude, True),
+                                                   table_name), **kwargs)
+
+
+# 静态 csv 只在首次访问时解析一次，之后直接复用 json 字符串
+@lru_cache(maxsize=None)
+def csv_json(path):
+    return pd.read_csv(path).to_json(orient='records')
+
+
+@cache_control(max_age=300)
 def hello(request):
-    data = pd.read_csv('data/demo.csv').to_json(orient='records')
+    data = csv_json('data/demo.csv')
     jsonStr = 'data=' + (data)
     context = {'jsonScript': jsonStr}
     return render(request, 'index.html', context)
@@ -29,8 +178,7 @@ def scatter(request):
     # server 端连接
     # conn = hive.Connection(host='10.10.76.185', port=10008)
     # 本地连接
-    conn = hive.Connection(host='106.75.22.252', port=10008)
-    data = pd.read_sql('''
+    data = read_hive('''
         select
         t1.account_name,
         t1.company_name,
@@ -52,29 +200,32 @@ def scatter(request):
     )t1
     having recency_num = 1
     order by pay_ttl desc
-    limit 200''', conn).to_json(orient='records')
+    limit 200''', '106.75.22.252', 10008).to_json(orient='records')
     jsonStr = 'data=' + (data)
     context = {'jsonScript': jsonStr}
     return render(request, 'scatter.html', context)
 
 
+@cache_control(max_age=300)
 def bar(req):
-    data = pd.read_csv('data/demo.csv').to_json(orient='records')
+    data = csv_json('data/demo.csv')
     jsonStr = 'data=' + (data)
     context = {'jsonScript': jsonStr}
     return render(req, 'scatter.html', context)
 
 
+@cache_control(max_age=300)
 def function_scatter(req):
-    data = pd.read_csv('data/dntest.csv').to_json(orient='records')
+    data = csv_json('data/dntest.csv')
     jsonStr = 'data=' + (data)
     context = {'jsonScript': jsonStr}
     return render(req, 'function_scatter.html', context)
 
 
+@cache_control(max_age=300)
 def word_cloud(req):
     # 读csv数据
-    data = pd.read_csv('data/xbot.csv').to_json(orient='records')
+    data = csv_json('data/xbot.csv')
     # 如果是页面输入sql，直接读URL的 query，获取html上的输入
     # sql = req.query.res
     # 本地连接
@@ -91,9 +242,9 @@ def function_scatter2(req):
 
 def loop(req):
     if isMac():
-        client = Client(host='106.75.2.168', port='9001', user='default', password='')
+        host = '106.75.2.168'
     else:
-        client = Client(host='10.10.149.76', port='9001', user='default', password='')
+        host = '10.10.149.76'
     # server 端连接 - carbon
     # conn = hive.Connection(host='10.10.76.185', port=10008)
     # server 连接 - clickhouse
@@ -104,36 +255,19 @@ def loop(req):
     #         select * from lppz.score_file_year_no_oot_20201227giftbox where sample_ind=1''', conn)
     # 本地 连接 - clickhouse
     start = time.time()
-    sql = 'select * from lppz.score_file_year_no_oot_20201227giftbox where sample_ind=1'
-    value, columns = client.execute(sql, columnar=True, with_column_types=True)
+    table_name = 'lppz.score_file_year_no_oot_20201227giftbox'
+    drop_cols = ['member_no', 'percentile', 'quintile', 'ventile', 'quarter']
+    value, columns = select_clickhouse(host, '9001', 'select {} from {} where sample_ind=1', table_name, drop_cols,
+                                       columnar=True, with_column_types=True)
     sqlTime = time.time() - start
     start = time.time()
-    data = pd.DataFrame({re.sub(r'\W', '_', col[0]): d for d, col in zip(value, columns)})
+    data = pd.DataFrame({NON_WORD_RE.sub('_', col[0]): d for d, col in zip(value, columns)})
     pdTime = time.time() - start
     start = time.time()
 
     decile = data['decile']
-    df = data.drop(['member_no', 'percentile', 'quintile', 'decile', 'ventile', 'quarter'], axis=1)
-    num_cols = df._get_numeric_data().columns
-    cat_cols = df[[i for i in df.columns if i not in num_cols]]
-    cat_cols = cat_cols.apply(condense_category, axis=0)
-    cds = {}
-    for cols in cat_cols:
-        # 聚合后的数据
-        ax = pd.crosstab(index=decile, columns=cat_cols[cols], normalize="index")
-        cds[cols] = ax.to_json(orient='records')
-
-    num_cols = df.select_dtypes(include=np.number)
-    list(num_cols)
-    quantile_list = [0, .2, .4, .6, .8, 1.]
-    for cols in num_cols:
-        try:
-            num_cols[cols] = pd.qcut(num_cols[cols], q=quantile_list, duplicates='drop')
-        except:
-            continue
-    for cols in num_cols:
-        ax = pd.crosstab(index=decile, columns=num_cols[cols], normalize="index")
-        cds[cols] = ax.to_json(orient='records')
+    df = data.drop('decile', axis=1)
+    cds = decile_charts(decile, df)
     chartTime = time.time() - start
 
     jsonStr = 'data=' + json.dumps(cds) + ";sqlTime={};pdTime={};chartTime={};".format(sqlTime, pdTime, chartTime)
@@ -147,9 +281,97 @@ def loop(req):
 
 # loop category 类别的数据处理
 def condense_category(col, min_freq=0.05, new_name='other'):
-    series = pd.value_counts(col)
-    mask = (series / series.sum()).lt(min_freq)
-    return pd.Series(np.where(col.isin(series[mask].index), new_name, col))
+    # factorize 一次得到编码，bincount 统计频次，空值不参与统计也不替换
+    codes, uniques = pd.factorize(col)
+    valid = codes >= 0
+    counts = np.bincount(codes[valid], minlength=len(uniques))
+    rare = counts / max(counts.sum(), 1) < min_freq
+    mask = np.zeros(len(codes), dtype=bool)
+    mask[valid] = rare[codes[valid]]
+    out = col.to_numpy(dtype=object, copy=True)
+    out[mask] = new_name
+    return pd.Series(out, index=col.index)
+
+
+def json_key(level):
+    # 与 DataFrame.to_json 的列名一致：日期 / 时间序列化为毫秒时间戳，其余取 str
+    if isinstance(level, (datetime.date, np.datetime64)):
+        return str(pd.Timestamp(level).value // 10 ** 6)
+    return str(level)
+
+
+def decile_crosstab(decile_codes, n_decile, codes, labels):
+    # 等价于 pd.crosstab(decile, col, normalize='index').to_json(orient='records')
+    # decile 只编码一次，计数矩阵用 bincount 一次求出，codes 为 -1 表示空值
+    # 转成文本后相同的取值（如 1 与 '1'）合并为同一列，计数相加
+    merged = {}
+    remap = np.array([merged.setdefault(label, len(merged)) for label in labels], dtype=np.intp)
+    labels = list(merged)
+    n_level = len(labels)
+    valid = (decile_codes >= 0) & (codes >= 0)
+    mat = np.bincount(decile_codes[valid] * n_level + remap[codes[valid]],
+                      minlength=n_decile * n_level).reshape(n_decile, n_level)
+    # 与 crosstab 一致，去掉没有数据的行和列
+    used = mat.sum(axis=0) > 0
+    labels = [label for label, keep in zip(labels, used) if keep]
+    mat = mat[:, used]
+    row_sum = mat.sum(axis=1, keepdims=True)
+    filled = row_sum[:, 0] > 0
+    ratio = mat[filled] / row_sum[filled]
+    return json.dumps([dict(zip(labels, row)) for row in ratio.tolist()])
+
+
+def edge_labels(edges):
+    # 图例标签（不沿用 qcut 的格式）：第一个区间 [lo, hi]，其余 (lo, hi]；
+    # 分位点按有效数字、不用科学计数法格式化，从 3 位起逐位增加直到文本互不相同，17 位时必然不同
+    for digits in range(3, 18):
+        texts = [np.format_float_positional(e, precision=digits, unique=False, fractional=False, trim='-')
+                 for e in edges]
+        if len(set(texts)) == len(texts):
+            break
+    labels = ['({}, {}]'.format(lo, hi) for lo, hi in zip(texts[:-1], texts[1:])]
+    labels[0] = '[' + labels[0][1:]
+    return labels
+
+
+def quantile_bins(values, quantile_list):
+    # 对每一列做等价于 pd.qcut(duplicates='drop') 的分箱，返回 (codes, labels)
+    # 所有列的分位点用一次 nanquantile 算出；右闭区间，第一个区间包含最小值
+    has_data = ~np.isnan(values).all(axis=0)
+    edges_all = np.full((len(quantile_list), values.shape[1]), np.nan)
+    if has_data.any():
+        edges_all[:, has_data] = np.nanquantile(values[:, has_data], quantile_list, axis=0)
+    for j in range(values.shape[1]):
+        x = values[:, j]
+        edges = np.unique(edges_all[:, j])
+        # 全空或常数列：qcut(duplicates='drop') 得到全空，crosstab 为空，页面不画图
+        if np.isnan(edges[0]) or len(edges) == 1:
+            yield np.full(len(x), -1), []
+            continue
+        codes = np.maximum(np.searchsorted(edges, x, side='left') - 1, 0)
+        codes[np.isnan(x)] = -1
+        yield codes, edge_labels(edges)
+
+
+# loop 图表数据：每一列 vs decile 的占比
+def decile_charts(decile, df):
+    decile_codes, decile_levels = pd.factorize(decile, sort=True)
+    n_decile = len(decile_levels)
+    num_cols = df._get_numeric_data().columns
+    cds = {}
+    for cols in df.columns:
+        if cols in num_cols:
+            continue
+        codes, levels = pd.factorize(condense_category(df[cols]), sort=True)
+        # 聚合后的数据
+        cds[cols] = decile_crosstab(decile_codes, n_decile, codes, [json_key(level) for level in levels])
+
+    num_cols = df.select_dtypes(include=np.number)
+    quantile_list = [0, .2, .4, .6, .8, 1.]
+    bins = quantile_bins(num_cols.to_numpy(dtype=float), quantile_list)
+    for cols, (codes, labels) in zip(num_cols.columns, bins):
+        cds[cols] = decile_crosstab(decile_codes, n_decile, codes, labels)
+    return cds
 
 
 def loop_tables_clickhouse(req, table_name):
@@ -162,61 +384,44 @@ def loop_tables_carbon(req, table_name):
 
 # lppz.score_file_year_no_oot_20201227giftbox
 def loop_tables(req, table_name, use_carbon=False):
-    if not table_name or table_name == '/':
+    if not table_name:
         jsonStr = 'data=null'
         context = {'jsonScript': jsonStr}
         return render(req, 'loop.html', context)
     start = time.time()
+    drop_cols = ['member_no', 'percentile', 'quintile', 'ventile']
     if not use_carbon:
         if isMac():
-            client = Client(host='106.75.2.168', port='9001', user='default', password='')
-            sql = "select * from {} where sample_ind=1 limit 1000".format(table_name)
+            host = '106.75.2.168'
+            sql = "select {} from {} where sample_ind=1 limit 1000"
         else:
-            client = Client(host='10.10.149.76', port='9001', user='default', password='')
-            sql = "select * from {} where sample_ind=1".format(table_name)
+            host = '10.10.149.76'
+            sql = "select {} from {} where sample_ind=1"
 
-        value, columns = client.execute(sql, columnar=True, with_column_types=True)
+        value, columns = select_clickhouse(host, '9001', sql, table_name, drop_cols,
+                                           columnar=True, with_column_types=True)
         sqlTime = time.time() - start
         start = time.time()
-        data = pd.DataFrame({re.sub(r'\W', '_', col[0]): d for d, col in zip(value, columns)})
+        data = pd.DataFrame({NON_WORD_RE.sub('_', col[0]): d for d, col in zip(value, columns)})
         pdTime = time.time() - start
         start = time.time()
     else:
         # 本地连接
         if isMac():
-            conn = hive.Connection(host='106.75.22.252', port=10018)
-            data = pd.read_sql("select * from {} where sample_ind=1 limit 1000".format(table_name), conn)
+            data = read_hive("select * from {} where sample_ind=1 limit 1000".format(table_name),
+                             '106.75.22.252', 10018)
         # server连接
         else:
-            conn = hive.Connection(host='10.10.76.185', port=10018)
-            data = pd.read_sql("select * from {} where sample_ind=1".format(table_name), conn)
+            data = read_hive("select * from {} where sample_ind=1".format(table_name), '10.10.76.185', 10018)
         sqlTime = time.time() - start
         start = time.time()
         pdTime = -1
 
     decile = data['decile']
-    df = data.drop(['member_no', 'percentile', 'quintile', 'decile', 'ventile'], axis=1)
+    # clickhouse 查询时已排除 drop_cols，carbon 仍需在这里去掉
+    df = data.drop(drop_cols + ['decile'], axis=1, errors='ignore')
     # df = data.drop(['member_no', 'percentile', 'quintile', 'decile', 'ventile', 'quarter'], axis=1)
-    num_cols = df._get_numeric_data().columns
-    cat_cols = df[[i for i in df.columns if i not in num_cols]]
-    cat_cols = cat_cols.apply(condense_category, axis=0)
-    cds = {}
-    for cols in cat_cols:
-        # 聚合后的数据
-        ax = pd.crosstab(index=decile, columns=cat_cols[cols], normalize="index")
-        cds[cols] = ax.to_json(orient='records')
-
-    num_cols = df.select_dtypes(include=np.number)
-    list(num_cols)
-    quantile_list = [0, .2, .4, .6, .8, 1.]
-    for cols in num_cols:
-        try:
-            num_cols[cols] = pd.qcut(num_cols[cols], q=quantile_list, duplicates='drop')
-        except:
-            continue
-    for cols in num_cols:
-        ax = pd.crosstab(index=decile, columns=num_cols[cols], normalize="index")
-        cds[cols] = ax.to_json(orient='records')
+    cds = decile_charts(decile, df)
     chartTime = time.time() - start
 
     jsonStr = 'data=' + json.dumps(cds) + ";sqlTime={};pdTime={};chartTime={};".format(sqlTime, pdTime, chartTime)
@@ -231,7 +436,7 @@ def loop_tables(req, table_name, use_carbon=False):
 def t_lag(request):
     # data = pd.read_csv('data/demo.csv').to_json(orient='records')
     # server 端连接
-    conn = hive.Connection(host='10.10.76.185', port=10008)
+    host, port = '10.10.76.185', 10008
     # 本地连接
     # conn = hive.Connection(host='106.75.22.252', port=10008)
     # t1.time  from_event to_event 是变量
@@ -279,7 +484,7 @@ def t_lag(request):
     #         order by 1'''
     # data = pd.read_sql(sql,conn,params=values).to_json(orient='records')
 
-    data = pd.read_sql('''
+    data = read_hive('''
         select 
     date,
     from_event,
@@ -317,7 +522,7 @@ where
     and from_event = 'feed_visit'
     and to_event = 'message_visit'
 group by 1,2,3
-order by 1''', conn).to_json(orient='records')
+order by 1''', host, port).to_json(orient='records')
     jsonStr = 'data=' + (data)
     context = {'jsonScript': jsonStr}
     return render(request, 't_lag.html', context)
@@ -328,15 +533,15 @@ def query_data(item):
     i, table_name = item
     try:
         if isMac():
-            conn = hive.Connection(host='106.75.22.252', port=10008)
+            host = '106.75.22.252'
         # server连接
         else:
-            conn = hive.Connection(host='10.10.76.185', port=10008)
+            host = '10.10.76.185'
         start = time.time()
         print('start {}'.format(i))
-        cdjs = pd.read_sql('select {},count(*) AS `count` '
-                           'from {} group by '
-                           '{} order by {}'.format(i, table_name, i, i), conn).to_json(orient='records')
+        cdjs = read_hive('select {},count(*) AS `count` '
+                         'from {} group by '
+                         '{} order by {}'.format(i, table_name, i, i), host, 10008).to_json(orient='records')
         print('end {}, took {}'.format(i, time.time() - start))
         return {'name': i, 'str': cdjs}
     except:
@@ -344,27 +549,22 @@ def query_data(item):
 
 
 def loop_feature(req, table_name):
-    if not table_name or table_name == '/':
+    if not table_name:
         jsonStr = 'data=null'
         context = {'jsonScript': jsonStr}
         return render(req, 'loop_feature.html', context)
     if isMac():
-        conn = hive.Connection(host='106.75.22.252', port=10018)
         # lppz.score_file_year_no_oot_20201231spending200
-        data = pd.read_sql("select * from {} limit 1".format(table_name), conn)
+        data = read_hive("select * from {} limit 1".format(table_name), '106.75.22.252', 10018)
     # server连接
     else:
-        conn = hive.Connection(host='10.10.76.185', port=10018)
-        data = pd.read_sql("select * from {} limit 1".format(table_name),
-                           conn)
+        data = read_hive("select * from {} limit 1".format(table_name), '10.10.76.185', 10018)
     df = data.drop(['member_no', 'percentile', 'quintile', 'decile', 'ventile', 'ltv',
                     'outcome_event_ind', 'sample_ind'], axis=1)
     # 取所有列名
     cols = df.columns.values.tolist()
     print(cols)
-    pool = multiprocessing.Pool(42)
-    csd = pool.map(query_data, [(i, table_name) for i in cols])
+    csd = list(FEATURE_POOL.map(query_data, [(i, table_name) for i in cols]))
     jsonStr = 'data=' + json.dumps(csd)
     context = {'jsonScript': jsonStr}
-    pool.close()
     return render(req, 'loop_feature.html', context)